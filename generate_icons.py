@@ -6,12 +6,18 @@ Applies the game's shared texture atlas.
 
 Usage:
   blender --background --python scripts/generate_icons.py
+  blender --background --python scripts/generate_icons.py -- --shard 0/4
+  blender --background --python scripts/generate_icons.py -- --hires
 """
 
 import bpy
+import hashlib
 import mathutils
 import os
+import sys
 import math
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 # Configuration
@@ -19,15 +25,49 @@ PROJECT_ROOT = "/home/siah/creative/city"
 MODELS_DIR = "src/public/models"
 TEXTURES_DIR = "src/public/textures"
 OUTPUT_DIR = "src/public/icons/models"
-ICON_SIZE = 256  # Render at 2x for better quality when scaled down
+ICON_SIZE = 128  # Antialiased by TAA + pixel filter; --hires renders at 2x
+PURGE_INTERVAL = 32  # Purge orphan data every N models
 
-# Global texture reference
+# Isometric view: elevation ~35° (true isometric), azimuth -45°
+ISO_ELEVATION = math.radians(35.264)  # arctan(1/sqrt(2)) for true isometric
+ISO_AZIMUTH = math.radians(-45)  # Rotated 90° counter-clockwise from 45°
+
+# Unit vector from model center towards the camera
+ISO_DIR = mathutils.Vector((
+    math.cos(ISO_ELEVATION) * math.cos(ISO_AZIMUTH),
+    math.cos(ISO_ELEVATION) * math.sin(ISO_AZIMUTH),
+    math.sin(ISO_ELEVATION)
+))
+
+# Global texture and material references
 base_texture = None
+shared_material = None
+
+def get_script_args():
+    """Return the arguments after Blender's `--` separator"""
+    argv = sys.argv
+    return argv[argv.index("--") + 1:] if "--" in argv else []
+
+def parse_shard():
+    """Parse `--shard i/N` from the script arguments"""
+    args = get_script_args()
+
+    if "--shard" not in args:
+        return 0, 1
+
+    try:
+        index, count = args[args.index("--shard") + 1].split("/")
+        index, count = int(index), int(count)
+    except (IndexError, ValueError):
+        raise ValueError("--shard expects a value of the form i/N, e.g. --shard 0/4")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Invalid shard {index}/{count}")
+    return index, count
 
 def clear_scene():
     """Remove all objects from the scene"""
-    bpy.ops.object.select_all(action='SELECT')
-    bpy.ops.object.delete()
+    for obj in list(bpy.data.objects):
+        bpy.data.objects.remove(obj, do_unlink=True)
 
     # Clear orphan data
     for block in bpy.data.meshes:
@@ -44,6 +84,9 @@ def load_game_texture():
 
     if os.path.exists(texture_path):
         base_texture = bpy.data.images.load(texture_path)
+        # Keep it in memory and alive for the whole run
+        base_texture.pack()
+        base_texture.use_fake_user = True
         print(f"Loaded texture: {texture_path}")
     else:
         print(f"WARNING: Texture not found: {texture_path}")
@@ -56,139 +99,263 @@ def setup_camera():
     cam_data.ortho_scale = 2.0  # Will be overridden per model
 
     camera = bpy.data.objects.new("IconCamera", cam_data)
+    # Aim back along the isometric direction; same for every model
+    camera.rotation_euler = (-ISO_DIR).to_track_quat('-Z', 'Y').to_euler()
     bpy.context.collection.objects.link(camera)
     bpy.context.scene.camera = camera
     return camera
 
+def add_sun(name, location, energy, rotation):
+    """Create a sun light through the data API (no operator overhead)"""
+    light = bpy.data.lights.new(name, 'SUN')
+    light.energy = energy
+    obj = bpy.data.objects.new(name, light)
+    bpy.context.collection.objects.link(obj)
+    obj.location = location
+    obj.rotation_euler = rotation
+    return obj
+
 def setup_lighting():
     """Create lighting for icons"""
     # Key light
-    bpy.ops.object.light_add(type='SUN', location=(5, -5, 10))
-    key = bpy.context.object
-    key.data.energy = 2.5
-    key.rotation_euler = (math.radians(45), 0, math.radians(45))
+    add_sun("Key", (5, -5, 10), 2.5, (math.radians(45), 0, math.radians(45)))
 
     # Fill light
-    bpy.ops.object.light_add(type='SUN', location=(-3, 3, 5))
-    fill = bpy.context.object
-    fill.data.energy = 1.0
-    fill.rotation_euler = (math.radians(60), 0, math.radians(-135))
+    add_sun("Fill", (-3, 3, 5), 1.0, (math.radians(60), 0, math.radians(-135)))
 
-def setup_render_settings():
+def enable_gpu_devices():
+    """Enable OPTIX (or CUDA) devices for Cycles, return True if any GPU was found"""
+    try:
+        prefs = bpy.context.preferences.addons['cycles'].preferences
+    except KeyError:
+        return False
+
+    for device_type in ('OPTIX', 'CUDA'):
+        try:
+            prefs.compute_device_type = device_type
+        except TypeError:
+            continue
+        prefs.get_devices()
+        gpus = [d for d in prefs.devices if d.type == device_type]
+        if gpus:
+            for d in prefs.devices:
+                d.use = (d.type != 'CPU')
+            print(f"Using Cycles on {device_type}: {', '.join(d.name for d in gpus)}")
+            return True
+
+    return False
+
+def setup_render_settings(size=ICON_SIZE):
     """Configure render settings"""
     scene = bpy.context.scene
 
-    scene.render.resolution_x = ICON_SIZE
-    scene.render.resolution_y = ICON_SIZE
+    scene.render.resolution_x = size
+    scene.render.resolution_y = size
+    scene.render.filter_size = 1.5
     scene.render.film_transparent = True
 
-    # Use Eevee
-    scene.render.engine = 'BLENDER_EEVEE_NEXT' if 'BLENDER_EEVEE_NEXT' in dir(bpy.types) else 'BLENDER_EEVEE'
+    if enable_gpu_devices():
+        # Cycles on the GPU; low sample count is plenty for icons
+        scene.render.engine = 'CYCLES'
+        scene.cycles.device = 'GPU'
+        scene.cycles.samples = 8
+        scene.cycles.use_adaptive_sampling = True
+        scene.cycles.max_bounces = 2
+        scene.cycles.use_denoising = True
+    else:
+        # Fall back to Eevee when no GPU compute device is available
+        scene.render.engine = 'BLENDER_EEVEE_NEXT' if 'BLENDER_EEVEE_NEXT' in dir(bpy.types) else 'BLENDER_EEVEE'
+        scene.eevee.taa_render_samples = 8
+
+        # Screen-space effects add passes a flat icon doesn't need
+        # (some of these no longer exist in Eevee Next)
+        for attr in ('use_bloom', 'use_ssr', 'use_gtao', 'use_motion_blur'):
+            if hasattr(scene.eevee, attr):
+                setattr(scene.eevee, attr, False)
+
+    # Skip post-processing stages
+    scene.render.use_compositing = False
+    scene.render.use_sequencer = False
+    scene.view_settings.view_transform = 'Standard'
 
     scene.render.image_settings.file_format = 'PNG'
     scene.render.image_settings.color_mode = 'RGBA'
 
-def apply_texture_to_objects(objects):
-    """Apply the game's texture to all mesh objects"""
-    global base_texture
+def build_shared_material():
+    """Build the single material every imported mesh shares"""
+    global shared_material
 
     if not base_texture:
+        shared_material = None
         return
 
-    for obj in objects:
-        if obj.type != 'MESH':
-            continue
+    mat = bpy.data.materials.new(name="GameMaterial")
+    mat.use_nodes = True
+    nodes = mat.node_tree.nodes
+    links = mat.node_tree.links
+
+    # Clear default nodes
+    nodes.clear()
 
-        # Create a new material with the texture
-        mat = bpy.data.materials.new(name="GameMaterial")
-        mat.use_nodes = True
-        nodes = mat.node_tree.nodes
-        links = mat.node_tree.links
+    # Create nodes
+    output = nodes.new('ShaderNodeOutputMaterial')
+    bsdf = nodes.new('ShaderNodeBsdfPrincipled')
+    tex_node = nodes.new('ShaderNodeTexImage')
 
-        # Clear default nodes
-        nodes.clear()
+    # Set texture
+    tex_node.image = base_texture
 
-        # Create nodes
-        output = nodes.new('ShaderNodeOutputMaterial')
-        bsdf = nodes.new('ShaderNodeBsdfPrincipled')
-        tex_node = nodes.new('ShaderNodeTexImage')
+    # Position nodes
+    output.location = (300, 0)
+    bsdf.location = (0, 0)
+    tex_node.location = (-300, 0)
 
-        # Set texture
-        tex_node.image = base_texture
+    # Link nodes
+    links.new(tex_node.outputs['Color'], bsdf.inputs['Base Color'])
+    links.new(bsdf.outputs['BSDF'], output.inputs['Surface'])
 
-        # Position nodes
-        output.location = (300, 0)
-        bsdf.location = (0, 0)
-        tex_node.location = (-300, 0)
+    # Survive orphan purges between models, when no mesh uses it
+    mat.use_fake_user = True
+    shared_material = mat
 
-        # Link nodes
-        links.new(tex_node.outputs['Color'], bsdf.inputs['Base Color'])
-        links.new(bsdf.outputs['BSDF'], output.inputs['Surface'])
+def apply_texture_to_objects(objects):
+    """Assign the shared game material to all mesh objects"""
+    if not shared_material:
+        return
 
-        # Apply material to mesh
+    for obj in objects:
+        if obj.type != 'MESH':
+            continue
         obj.data.materials.clear()
-        obj.data.materials.append(mat)
+        obj.data.materials.append(shared_material)
 
 def import_model(filepath):
-    """Import a GLB model"""
-    bpy.ops.import_scene.gltf(filepath=filepath)
+    """Import a GLB model, keeping only its geometry"""
+    options = dict(
+        filepath=filepath,
+        import_pack_images=False,
+        guess_original_bind_pose=False,
+    )
+    try:
+        bpy.ops.import_scene.gltf(import_webp_texture=False, **options)
+    except TypeError:
+        # Older importers don't know about WebP
+        bpy.ops.import_scene.gltf(**options)
+
+    discard_imported_data()
     return list(bpy.context.selected_objects)
 
-def get_model_bounds(objects):
-    """Get bounding box of all mesh objects"""
-    min_co = [float('inf')] * 3
-    max_co = [float('-inf')] * 3
+def discard_imported_data():
+    """Drop images, materials and animations the importer brought in"""
+    for action in list(bpy.data.actions):
+        bpy.data.actions.remove(action)
+
+    # Without the game texture the model keeps its own materials
+    if not shared_material:
+        return
+
+    for img in list(bpy.data.images):
+        if img is not base_texture and img.type == 'IMAGE':
+            bpy.data.images.remove(img)
+    for mat in list(bpy.data.materials):
+        if mat is not shared_material:
+            bpy.data.materials.remove(mat)
+
+def get_world_aabb(objects):
+    """Return world-space (min, max) of all meshes without transforming corners.
+
+    Each local bound_box is a center plus half-extents; under the 3x3 block R
+    the world half-extents are |R| @ he, so one matrix-vector product per mesh
+    replaces the 8-corner sweep.
+    """
+    mn = np.full(3, np.inf)
+    mx = np.full(3, -np.inf)
 
     for obj in objects:
-        if obj.type == 'MESH':
-            for corner in obj.bound_box:
-                world_corner = obj.matrix_world @ mathutils.Vector(corner)
-                for i in range(3):
-                    min_co[i] = min(min_co[i], world_corner[i])
-                    max_co[i] = max(max_co[i], world_corner[i])
-
-    if min_co[0] == float('inf'):
+        if obj.type != 'MESH':
+            continue
+        # bound_box corner 0 is (min, min, min) and corner 6 is (max, max, max)
+        bb = obj.bound_box
+        lo = np.array(bb[0], dtype=np.float64)
+        hi = np.array(bb[6], dtype=np.float64)
+
+        M = np.array(obj.matrix_world)
+        R = M[:3, :3]
+        center = R @ ((lo + hi) * 0.5) + M[:3, 3]
+        he = np.abs(R) @ ((hi - lo) * 0.5)
+
+        mn = np.minimum(mn, center - he)
+        mx = np.maximum(mx, center + he)
+
+    if mn[0] == np.inf:
         return None, None
+    return mn, mx
 
-    center = [(min_co[i] + max_co[i]) / 2 for i in range(3)]
-    return center, [max_co[i] - min_co[i] for i in range(3)]
+def to_world(obj, local):
+    """Transform an (N, 3) array of local points by the object's world matrix"""
+    # Rotation/scale block plus translation; no homogeneous coordinate needed
+    M = np.array(obj.matrix_world)
+    return local @ M[:3, :3].T + M[:3, 3]
 
-def get_bounding_sphere(objects):
-    """Return center and radius of bounding sphere encompassing all objects."""
-    all_corners = []
+def get_world_corners(objects):
+    """Return an (8N, 3) array of world-space bound_box corners for all meshes"""
+    corners = []
 
     for obj in objects:
         if obj.type != 'MESH':
             continue
-        for corner in obj.bound_box:
-            world_corner = obj.matrix_world @ mathutils.Vector(corner)
-            all_corners.append(world_corner)
+        corners.append(to_world(obj, np.array(obj.bound_box, dtype=np.float64)))
 
-    if not all_corners:
-        return mathutils.Vector((0, 0, 0)), 1.0
+    if not corners:
+        return None
+    return np.concatenate(corners)
+
+def get_world_vertices(objects):
+    """Return an (N, 3) array of world-space vertex positions for all meshes"""
+    points = []
+
+    for obj in objects:
+        if obj.type != 'MESH':
+            continue
+        mesh = obj.data
+        if not mesh.vertices:
+            continue
+        local = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+        mesh.vertices.foreach_get('co', local)
+        points.append(to_world(obj, local.reshape(-1, 3).astype(np.float64)))
+
+    if not points:
+        return None
+    return np.concatenate(points)
 
-    # Calculate bounding box
-    min_corner = mathutils.Vector((
-        min(c.x for c in all_corners),
-        min(c.y for c in all_corners),
-        min(c.z for c in all_corners)
-    ))
-    max_corner = mathutils.Vector((
-        max(c.x for c in all_corners),
-        max(c.y for c in all_corners),
-        max(c.z for c in all_corners)
-    ))
+def get_model_bounds(objects):
+    """Get bounding box of all mesh objects"""
+    mn, mx = get_world_aabb(objects)
+
+    if mn is None:
+        return None, None
+
+    return ((mn + mx) * 0.5).tolist(), (mx - mn).tolist()
+
+def get_bounding_sphere(objects, exact=False):
+    """Return center and radius of bounding sphere encompassing all objects.
+
+    By default the sphere is fitted to the transformed bound_box corners; with
+    exact=True it is fitted to the mesh vertices, giving a tighter radius.
+    """
+    pts = get_world_vertices(objects) if exact else get_world_corners(objects)
+
+    if pts is None:
+        return mathutils.Vector((0, 0, 0)), 1.0
 
     # Center is midpoint of bounding box
-    center = (min_corner + max_corner) / 2
+    c = (pts.min(0) + pts.max(0)) * 0.5
 
-    # Radius is distance from center to farthest corner
-    radius = max((corner - center).length for corner in all_corners)
+    # Radius is distance from center to farthest point
+    r = np.sqrt(((pts - c) ** 2).sum(1)).max()
 
     # Ensure minimum radius to avoid issues with flat/tiny models
-    radius = max(radius, 0.01)
-
-    return center, radius
+    return mathutils.Vector(c), float(max(r, 0.01))
 
 def fit_camera_to_model(camera, objects):
     """Position and configure orthographic camera to frame objects using bounding sphere."""
@@ -204,40 +371,72 @@ def fit_camera_to_model(camera, objects):
     camera.data.ortho_scale = radius * 2 * padding
 
     # Position camera at isometric angle, at safe distance from center
-    # Using spherical coordinates: elevation ~35° (true isometric), azimuth -45°
-    elevation = math.radians(35.264)  # arctan(1/sqrt(2)) for true isometric
-    azimuth = math.radians(-45)  # Rotated 90° counter-clockwise from 45°
+    # (rotation is fixed in setup_camera since the view direction never changes)
     distance = radius * 4  # Safe distance for orthographic (doesn't affect size)
-
-    camera.location = mathutils.Vector((
-        center.x + distance * math.cos(elevation) * math.cos(azimuth),
-        center.y + distance * math.cos(elevation) * math.sin(azimuth),
-        center.z + distance * math.sin(elevation)
-    ))
-
-    # Aim camera at center using track quaternion
-    direction = center - camera.location
-    camera.rotation_euler = direction.to_track_quat('-Z', 'Y').to_euler()
+    camera.location = center + ISO_DIR * distance
 
     # Set clip planes based on actual distance
     camera.data.clip_start = max(0.01, distance - radius * 2)
     camera.data.clip_end = distance + radius * 3
 
 def delete_objects(objects):
-    """Delete objects and their materials"""
-    for obj in objects:
-        # Remove materials
-        if obj.type == 'MESH':
-            for mat in obj.data.materials:
-                if mat:
-                    bpy.data.materials.remove(mat)
-        bpy.data.objects.remove(obj, do_unlink=True)
+    """Delete objects (the shared material is kept for the next model)"""
+    bpy.data.batch_remove(ids=objects)
+
+def purge_orphans():
+    """Free meshes and other data left behind by deleted models"""
+    bpy.data.orphans_purge(do_local_ids=True, do_recursive=True)
+
+def warmup_render(camera):
+    """Render a proxy cube once so shader compile and texture upload happen before the loop"""
+    verts = [(x, y, z) for x in (-0.5, 0.5) for y in (-0.5, 0.5) for z in (-0.5, 0.5)]
+    faces = [(0, 1, 3, 2), (4, 6, 7, 5), (0, 4, 5, 1), (2, 3, 7, 6), (0, 2, 6, 4), (1, 5, 7, 3)]
+    mesh = bpy.data.meshes.new("WarmupCube")
+    mesh.from_pydata(verts, [], faces)
+    cube = bpy.data.objects.new("WarmupCube", mesh)
+    bpy.context.collection.objects.link(cube)
+
+    apply_texture_to_objects([cube])
+    bpy.context.view_layer.update()
+    fit_camera_to_model(camera, [cube])
+    bpy.ops.render.render(write_still=False)
+
+    delete_objects([cube])
+    bpy.data.meshes.remove(mesh)
 
 def render_icon(output_path):
     """Render to file"""
     bpy.context.scene.render.filepath = output_path
     bpy.ops.render.render(write_still=True)
 
+def hash_file(filepath):
+    """Content hash of a GLB, used to skip models whose icon is up to date"""
+    with open(filepath, "rb") as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+def hash_render_settings():
+    """Hash of everything besides the GLB that ends up in an icon.
+
+    Covers the texture atlas, the engine and the output resolution (so a
+    --hires run re-renders icons made at the normal size).
+    """
+    h = hashlib.blake2b(digest_size=16)
+    texture_path = os.path.join(PROJECT_ROOT, TEXTURES_DIR, "base.png")
+    if os.path.exists(texture_path):
+        with open(texture_path, "rb") as f:
+            h.update(f.read())
+
+    render = bpy.context.scene.render
+    h.update(f"{render.engine}:{render.resolution_x}x{render.resolution_y}".encode())
+    return h.hexdigest()
+
+def is_icon_current(icon_path, hash_path, cache_key):
+    """True if the icon exists and was rendered with this GLB and settings"""
+    if not os.path.exists(icon_path) or not os.path.exists(hash_path):
+        return False
+    with open(hash_path) as f:
+        return f.read().strip() == cache_key
+
 def generate_all_icons():
     """Main function"""
     models_path = os.path.join(PROJECT_ROOT, MODELS_DIR)
@@ -251,32 +450,78 @@ def generate_all_icons():
     # Setup
     clear_scene()
     load_game_texture()
+    build_shared_material()
     camera = setup_camera()
     setup_lighting()
-    setup_render_settings()
+    setup_render_settings(ICON_SIZE * 2 if "--hires" in get_script_args() else ICON_SIZE)
+    settings_hash = hash_render_settings()
 
-    # Process models
-    glb_files = sorted(Path(models_path).glob("*.glb"))
+    # Process models (only this worker's slice when sharded)
+    shard_index, shard_count = parse_shard()
+    glb_files = sorted(Path(models_path).glob("*.glb"))[shard_index::shard_count]
     total = len(glb_files)
-    print(f"Found {total} models")
-
-    for i, glb_file in enumerate(glb_files):
-        model_name = glb_file.stem
-        icon_path = os.path.join(output_path, f"{model_name}.png")
-
-        print(f"[{i+1}/{total}] {model_name}")
-
-        try:
-            objects = import_model(str(glb_file))
-
-            if objects:
-                apply_texture_to_objects(objects)
-                fit_camera_to_model(camera, objects)
-                render_icon(icon_path)
-                delete_objects(objects)
-
-        except Exception as e:
-            print(f"  ERROR: {e}")
+    print(f"Found {total} models (shard {shard_index}/{shard_count})")
+
+    # Warm up lazily, so empty shards and fully cached runs skip it
+    warmed_up = False
+    imported = 0
+
+    # Background reader for the next model's file
+    with ThreadPoolExecutor(max_workers=1) as prefetch:
+        if glb_files:
+            pending = prefetch.submit(hash_file, glb_files[0])
+
+        for i, glb_file in enumerate(glb_files):
+            model_name = glb_file.stem
+            icon_path = os.path.join(output_path, f"{model_name}.png")
+            hash_path = f"{icon_path}.hash"
+            current = pending
+
+            # Read (and hash) the next GLB while this one imports and renders,
+            # so the importer finds it in the OS page cache
+            if i + 1 < total:
+                pending = prefetch.submit(hash_file, glb_files[i + 1])
+
+            try:
+                cache_key = f"{current.result()}:{settings_hash}"
+            except OSError as e:
+                print(f"[{i+1}/{total}] {model_name}")
+                print(f"  ERROR: {e}")
+                continue
+
+            if is_icon_current(icon_path, hash_path, cache_key):
+                print(f"[{i+1}/{total}] {model_name} (unchanged, skipped)")
+                continue
+
+            print(f"[{i+1}/{total}] {model_name}")
+
+            if not warmed_up:
+                warmed_up = True
+                try:
+                    warmup_render(camera)
+                except Exception as e:
+                    print(f"  WARNING: warmup render failed: {e}")
+
+            try:
+                objects = import_model(str(glb_file))
+
+                if objects:
+                    apply_texture_to_objects(objects)
+                    bpy.context.view_layer.update()
+                    fit_camera_to_model(camera, objects)
+                    render_icon(icon_path)
+                    delete_objects(objects)
+
+                    with open(hash_path, "w") as f:
+                        f.write(cache_key)
+
+            except Exception as e:
+                print(f"  ERROR: {e}")
+
+            # Only models that went through import leave data behind
+            imported += 1
+            if imported % PURGE_INTERVAL == 0:
+                purge_orphans()
 
     print(f"\nDone! {total} icons in {output_path}")
 
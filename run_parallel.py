@@ -0,0 +1,45 @@
+"""
+Parallel launcher for generate_icons.py
+
+Splits the GLB batch across N background Blender processes, each pinned
+to its own GPU via CUDA_VISIBLE_DEVICES. Every model writes its own PNG,
+so the shards never collide.
+
+Usage:
+  python scripts/run_parallel.py [N]   # N defaults to 1
+"""
+
+import os
+import subprocess
+import sys
+from multiprocessing import Pool
+
+BLENDER = os.environ.get("BLENDER", "blender")
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "generate_icons.py")
+
+def run_shard(args):
+    """Render one shard in its own Blender process"""
+    k, n = args
+    env = {**os.environ, "CUDA_VISIBLE_DEVICES": str(k)}
+    result = subprocess.run(
+        # --python-exit-code makes an uncaught script error fail the process
+        [BLENDER, "--background", "--python-exit-code", "1", "--python", SCRIPT,
+         "--", "--shard", f"{k}/{n}"],
+        env=env,
+    )
+    return result.returncode
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+
+    with Pool(n) as pool:
+        codes = pool.map(run_shard, [(k, n) for k in range(n)])
+
+    failed = [k for k, code in enumerate(codes) if code != 0]
+    if failed:
+        print(f"Shards failed: {failed}")
+        sys.exit(1)
+    print(f"Done! {n} shards")
+
+if __name__ == "__main__":
+    main()